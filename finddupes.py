@@ -4,14 +4,54 @@ import argparse
 import hashlib
 import os
 import fnmatch
+import re
+import threading
 
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import lru_cache
 from logging import getLogger
 from multiprocessing.pool import ThreadPool
 
+try:
+    import ssl
+except ImportError:  # pragma: no cover
+    ssl = None
+
+try:
+    import blake3
+except ImportError:  # pragma: no cover
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:  # pragma: no cover
+    xxhash = None
+
 logger = getLogger(__name__)
 
+# Free list of `read_buffer()` buffers, shared by every thread so they outlive the per-call pools
+_read_buffers = []
+
 DEFAULT_MIN_SIZE = 0
 DEFAULT_MAX_SIZE = 1000000000
+DEFAULT_PREFIX_SIZE = 64 * 1024
+# Size of each read while hashing, and how far ahead of the hash files are read; bounded so readahead
+# can't outrun the page cache
+READAHEAD_WINDOW = 8 * 1024 * 1024
+
+# Any object with the hashlib `.update()`/`.digest()` protocol will do. Dupe detection only needs an
+# exclusionary hash, so the fast non-cryptographic blake3 and xxh3 are offered too when their packages are
+# installed. They are never picked automatically, only when requested with `--hash`.
+HASH_FUNCTIONS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+}
+if blake3 is not None:  # pragma: no cover
+    HASH_FUNCTIONS['blake3'] = blake3.blake3
+if xxhash is not None:  # pragma: no cover
+    HASH_FUNCTIONS['xxh3'] = xxhash.xxh3_64
 
 
 def options():  # pragma: no cover
@@ -35,11 +75,80 @@ def options():  # pragma: no cover
                         help='Use JSON Output')
     parser.add_argument('--workers', type=int, default=16,
                         help='Number of worker threads to spawn')
+    parser.add_argument('--walk-workers', type=int, default=1,
+                        help='Number of threads scanning directories (helps on cold disks and network filesystems)')
+    parser.add_argument('--hash', default='sha256', choices=sorted(HASH_FUNCTIONS),
+                        help='Hash function used to compare file contents')
+    parser.add_argument('--verify', action="store_true", default=False,
+                        help='Compare files byte-by-byte after hashing to rule out hash collisions')
     parser.add_argument('path', type=str, help='The directory path to search')
     return parser.parse_args()
 
 
-def walk(path, followlinks=False, globs=None, exclusion_globs=None):
+def sha256_is_accelerated():
+    """ Returns True if `hashlib.sha256` is backed by an OpenSSL able to use the CPU's SHA extensions.
+
+    OpenSSL 1.1.1+ dispatches SHA-256 to SHA-NI where the CPU supports it, which makes it faster
+    than software md5. Python builds without OpenSSL's hashlib fall back to CPython's own software
+    implementation, as do older OpenSSL versions. hashlib doesn't report its OpenSSL version, so the
+    one `ssl` was built against is used; CPython links both modules against the same library. Builds
+    without `ssl` at all have no OpenSSL to check.
+
+    :return: `bool`
+    """
+    if ssl is None:
+        return False
+    return hashlib.sha256.__name__ == 'openssl_sha256' and ssl.OPENSSL_VERSION_INFO >= (1, 1, 1)
+
+
+def compile_globs(globs):
+    """ Compiles a list of filename globs into a single regular expression that matches any of them.
+
+    Matching one precompiled pattern per entry is much cheaper than calling `fnmatch.fnmatch` once
+    per glob. Patterns are case-normalized the same way `fnmatch.fnmatch` does, so names must be
+    passed through `os.path.normcase` before matching.
+
+    :param globs: A list of glob strings (e.g.: ['*.txt', '*.gif'])
+    :return: compiled regular expression, or `None` if `globs` is empty
+    """
+    if not globs:
+        return None
+    return re.compile('|'.join(f'(?:{fnmatch.translate(os.path.normcase(glob))})' for glob in globs))
+
+
+def scan_directory(directory, followlinks=False, glob_re=None, exclusion_re=None):
+    """ Lists a single directory, splitting its entries into files and directories to descend into.
+
+    :param directory: A directory string
+    :param followlinks: If True, include symlinked directories in the returned directories (default: False)
+    :param glob_re: compiled globs (see `compile_globs`) that file names must match, or `None`
+    :param exclusion_re: compiled globs of file and directory names to leave out, or `None`
+    :return: `(files, directories)` where `files` is a list of os.DirEntry instances and
+             `directories` a list of path strings.
+    """
+    files = []
+    directories = []
+    try:
+        path_iter = os.scandir(directory)
+    except OSError:
+        logger.warning(f"Skipping Directory (OSError): {directory}")
+        return files, directories
+
+    with path_iter:
+        for entry in path_iter:
+            if exclusion_re and exclusion_re.match(os.path.normcase(entry.name)):
+                continue
+            # DirEntry answers these from the directory listing where it can, and caches any stat it
+            # has to make. Not following symlinks here keeps linked directories out of the walk.
+            if entry.is_dir(follow_symlinks=followlinks):
+                directories.append(entry.path)
+            elif entry.is_file():
+                if not glob_re or glob_re.match(os.path.normcase(entry.name)):
+                    files.append(entry)
+    return files, directories
+
+
+def walk(path, followlinks=False, globs=None, exclusion_globs=None, workers=1):
     """ Iterates over `path` and yields os.DirEntry objects for every file in the path.
 
     this is similar to:
@@ -47,74 +156,132 @@ def walk(path, followlinks=False, globs=None, exclusion_globs=None):
     for root, dirs, files in os.walk(path):
         os.walk
 
+    Directories are visited breadth-first from a queue rather than by recursion, so deeply nested
+    trees don't build up a chain of nested generators. With `workers` > 1, directories are scanned on
+    a pool of threads while earlier results are being yielded, which hides the latency of `scandir`
+    on cold disks and network filesystems.
+
     :param followlinks: If True, traverse symlinked directories (default: False)
     :param path: A directory string (e.g.: '/home/tevans/' or '../..')
-    :returns: Yields an `os.DirEntry` instance for every file in path.
+    :param workers: number of threads scanning directories (default: 1, scan in the calling thread)
+    :returns: Yields an `os.DirEntry` instance for every file in path. Its `stat()` result is cached,
+              so the size and hash passes never stat a file twice.
     """
-    try:
-        path_iter = os.scandir(path)
-    except OSError as exc:
-        logger.warning(f"Skipping Directory (OSError): {path}")
+    glob_re = compile_globs(globs)
+    exclusion_re = compile_globs(exclusion_globs)
+
+    def scan(directory):
+        return scan_directory(directory, followlinks=followlinks, glob_re=glob_re, exclusion_re=exclusion_re)
+
+    if workers <= 1:
+        pending = deque([path])
+        while pending:
+            files, directories = scan(pending.popleft())
+            pending.extend(directories)
+            yield from files
         return
 
-    walk_dirs = []
-    with path_iter:
-        for entry in path_iter:
-            if exclusion_globs and any(
-                    fnmatch.fnmatch(entry.name, glob) for glob in
-                    exclusion_globs):
-                continue
-            if entry.is_dir():
-                if followlinks:
-                    walk_into = True
-                else:
-                    try:
-                        is_symlink = entry.is_symlink()
-                    except OSError:
-                        # If is_symlink() raises an OSError, consider that the
-                        # entry is not a symbolic link, same behaviour than
-                        # os.path.islink().
-                        is_symlink = False
-                    walk_into = not is_symlink
-
-                if walk_into:
-                    walk_dirs.append(entry.path)
-            if entry.is_file():
-                if not globs or any(
-                        fnmatch.fnmatch(entry.name, glob) for glob in globs):
-                    yield entry
-
-    for directory in walk_dirs:
-        for entry in walk(directory, followlinks=followlinks, globs=globs,
-                          exclusion_globs=exclusion_globs):
-            yield entry
+    with ThreadPool(workers) as pool:
+        pending = deque([pool.apply_async(scan, (path,))])
+        while pending:
+            files, directories = pending.popleft().get()
+            pending.extend(pool.apply_async(scan, (directory,)) for directory in directories)
+            yield from files
 
 
-def read_chunks(file_object, chunk_size=1024):
-    """Lazy function (generator) to read a file piece by piece.
-    Default chunk size: 1k."""
+@contextmanager
+def read_buffer():
+    """ Lends out a reusable read buffer, a writable memoryview of `READAHEAD_WINDOW` bytes.
+
+    Buffers are returned to a free list when the `with` block exits, so reading never allocates (and
+    page faults in) a fresh `bytes` object per chunk, and a buffer is only created when every
+    existing one is in use.
+    """
+    try:
+        buffer = _read_buffers.pop()
+    except IndexError:
+        buffer = memoryview(bytearray(READAHEAD_WINDOW))
+    try:
+        yield buffer
+    finally:
+        _read_buffers.append(buffer)
+
+
+def read_chunks(file_object, buffer):
+    """Lazy function (generator) to read a file piece by piece into `buffer`.
+    Yields memoryview slices of `buffer`, each only valid until the next chunk is read."""
     while True:
-        data = file_object.read(chunk_size)
-        if not data:
+        size = file_object.readinto(buffer)
+        if not size:
             break
-        yield data
+        yield buffer[:size]
+
 
+def fadvise(fd, advice, offset=0, length=0):
+    """ Passes an access pattern hint for a range of the open file `fd` to the kernel.
 
-def hash_key(hashfunc=hashlib.md5):
+    This is a no-op on platforms without `os.posix_fadvise` (Windows, macOS).
+
+    :param fd: an open file object
+    :param advice: name of the `os.POSIX_FADV_*` constant to pass (e.g.: 'POSIX_FADV_WILLNEED')
+    :param offset: start of the range in bytes (default: 0)
+    :param length: length of the range in bytes, 0 meaning to the end of the file (default: 0)
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd.fileno(), offset, length, getattr(os, advice))
+
+
+def hash_key(hashfunc=hashlib.sha256, hash_states=None, start_offset=0, drop_cache=True):
     """ Returns a function that uses `hashfunc` to hash files and return the generated hash in bytes.
 
+    Before reading, the file is marked sequential so the kernel uses its largest readahead window.
+    Once hashed, its pages are dropped from the page cache (unless `drop_cache` is False) so a scan
+    doesn't evict data other programs are using. This also drops pages of the file that were already
+    cached before the scan started.
+
+    Files are read unbuffered, `READAHEAD_WINDOW` bytes at a time, into a reusable `read_buffer()`, so
+    no `bytes` object is allocated per chunk, and each window is hashed in one `update()` call, which
+    lets hashlib release the GIL while it works through it. Before a window is hashed, the following
+    one is queued for readahead, so the device stays busy without reading so far ahead that pages are
+    evicted before they are hashed. Files are read rather than memory mapped because a mapped file
+    that shrinks while it is being hashed raises SIGBUS, which would kill the whole scan.
+
+    Empty files all share the digest of no data, so they are never opened.
+
+    If a file's path is in `hash_states`, its running hash object (as left by `prefix_hash_key`) is
+    taken from there and hashing resumes at `start_offset` instead of re-reading the prefix.
+
     If the file cannot be hashed (due to permissions errors, for example), returns `None`
 
-    :param hashfunc: hash function to use (default: hashlib.md5)
+    :param hashfunc: hash function to use (default: hashlib.sha256)
+    :param hash_states: optional dict of path -> hash object that has already consumed `start_offset` bytes
+    :param start_offset: number of leading bytes already fed to the objects in `hash_states` (default: 0)
+    :param drop_cache: If True, drop each file's pages from the page cache once hashed (default: True)
     :return: hashing function
     """
+    empty_digest = hashfunc().digest()
 
     def _(_file):
         try:
-            with open(_file.path, 'rb') as fd:
-                _h = hashfunc()
-                for chunk in read_chunks(fd, chunk_size=1024*1024*10):
-                    _h.update(chunk)
+            size = _file.stat().st_size
+            if size == 0:
+                return empty_digest
+            with open(_file.path, 'rb', buffering=0) as fd:
+                fadvise(fd, 'POSIX_FADV_SEQUENTIAL')
+                _h = hash_states.pop(_file.path, None) if hash_states else None
+                if _h is None:
+                    _h, offset = hashfunc(), 0
+                else:
+                    offset = start_offset
+                fd.seek(offset)
+                with read_buffer() as buffer:
+                    for chunk in read_chunks(fd, buffer):
+                        offset += len(chunk)
+                        if offset < size:
+                            fadvise(fd, 'POSIX_FADV_WILLNEED', offset, READAHEAD_WINDOW)
+                        _h.update(chunk)
+                if drop_cache:
+                    fadvise(fd, 'POSIX_FADV_DONTNEED')
                 return _h.digest()
         except (OSError, PermissionError):
             logger.warning(
@@ -123,6 +290,40 @@ def hash_key(hashfunc=hashlib.md5):
     return _
 
 
+def prefix_hash_key(nbytes=DEFAULT_PREFIX_SIZE, hashfunc=hashlib.sha256, hash_states=None):
+    """ Returns a function that hashes the first `nbytes` of a file and returns the generated hash in bytes.
+
+    This is a cheap prefilter: files whose leading bytes differ cannot be duplicates, so most
+    candidates can be eliminated without reading them in full.
+
+    If `hash_states` is given, the running hash object for each file is stored in it under the file's
+    path, so `hash_key` can carry on from byte `nbytes` rather than hashing the prefix again.
+
+    If the file cannot be hashed (due to permissions errors, for example), returns `None`
+
+    :param nbytes: number of bytes to read from the start of each file (default: 64KiB)
+    :param hashfunc: hash function to use (default: hashlib.sha256)
+    :param hash_states: optional dict that receives a path -> hash object entry for every file hashed
+    :return: hashing function
+    """
+    empty_digest = hashfunc().digest()
+
+    def _(_file):
+        try:
+            if _file.stat().st_size == 0:
+                return empty_digest
+            with open(_file.path, 'rb') as fd:
+                _h = hashfunc(fd.read(nbytes))
+            if hash_states is not None:
+                hash_states[_file.path] = _h
+            return _h.digest()
+        except (OSError, PermissionError):
+            logger.warning(
+                f"Skipping File (Could Not Open To Read): {_file.path}")
+
+    return _
+
+
 def size_key(min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE):
     """ Returns a function that stats a file and returns its size.
 
@@ -140,47 +341,166 @@ def size_key(min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE):
     return _
 
 
-def group_by_key(fileset, keyfunc, min_group_size=2, workers=16):
+@lru_cache(maxsize=None)
+def is_rotational(device):
+    """ Returns True if `device` (an `st_dev` value) is backed by a spinning disk.
+
+    Uses `/sys/dev/block/<major>:<minor>`, checking the parent disk when `device` is a partition.
+    Anything that can't be identified (non-Linux platforms, network or virtual filesystems) is
+    treated as non-rotational.
+
+    :param device: device id, as found in `os.stat_result.st_dev`
+    :return: `bool`
+    """
+    if not hasattr(os, 'major'):  # pragma: no cover
+        return False
+    sys_path = os.path.realpath(f'/sys/dev/block/{os.major(device)}:{os.minor(device)}')
+    for queue_dir in (sys_path, os.path.dirname(sys_path)):
+        try:
+            with open(os.path.join(queue_dir, 'queue', 'rotational')) as fd:
+                return fd.read().strip() == '1'
+        except OSError:
+            continue
+    return False
+
+
+def evaluate_keys(fileset, keyfunc, workers=16, chunksize=1):
+    """ Evaluates `keyfunc` for every os.DirEntry in `fileset` on a pool of `workers` threads.
+
+    Results are yielded as soon as they are ready, in no particular order. `ThreadPool` would
+    otherwise pull the whole of `fileset` into its task queue up front, so entries are fed to it
+    through a window of `workers * chunksize * 4`: a new entry is only taken from `fileset` once an
+    earlier one has been yielded, which keeps memory bounded however large `fileset` is.
+
+    :param fileset: An iterable of os.DirEntry instances.
+    :param keyfunc: A function that takes an os.DirEntry as its sole argument and returns a hashable key.
+    :param workers: number of worker threads (default: 16)
+    :param chunksize: number of entries handed to a worker at a time (default: 1)
+    :returns: Yields `(key, entry)` tuples.
+    """
+    in_flight = threading.Semaphore(workers * chunksize * 4)
+    done = False
+
+    def evaluate(entry):
+        return keyfunc(entry), entry
+
+    def throttled():
+        for entry in fileset:
+            in_flight.acquire()
+            if done:
+                return
+            yield entry
+
+    with ThreadPool(workers) as pool:
+        try:
+            for keyed in pool.imap_unordered(evaluate, throttled(), chunksize=chunksize):
+                in_flight.release()
+                yield keyed
+        finally:
+            # Wake the pool's task feeder if it is waiting for room, so the pool can shut down
+            done = True
+            in_flight.release()
+
+
+def evaluate_by_device(fileset, keyfunc, workers=16, devicefunc=None):
+    """ Evaluates `keyfunc` for every os.DirEntry in `fileset`, scheduling the work per device.
+
+    Files on different devices are evaluated concurrently. Within a device, up to `workers` files are
+    evaluated at once, except on spinning disks where reading several files at a time makes the heads
+    thrash, so those are read one file at a time.
+
+    :param fileset: A list of os.DirEntry instances.
+    :param keyfunc: A function that takes an os.DirEntry as its sole argument and returns a hashable key.
+    :param workers: number of worker threads per non-rotational device (default: 16)
+    :param devicefunc: A function returning the device of an item in `fileset` (default: its `stat().st_dev`)
+    :returns: Yields `(key, entry)` tuples, a device at a time.
+    """
+    files_by_device = defaultdict(list)
+    for entry in fileset:
+        files_by_device[devicefunc(entry) if devicefunc else entry.stat().st_dev].append(entry)
+
+    def evaluate_device(device):
+        device_workers = 1 if is_rotational(device) else workers
+        return list(evaluate_keys(files_by_device[device], keyfunc, workers=device_workers))
+
+    with ThreadPool(max(len(files_by_device), 1)) as pool:
+        for device_keyed in pool.imap_unordered(evaluate_device, files_by_device):
+            yield from device_keyed
+
+
+def group_by_key(fileset, keyfunc, min_group_size=2, workers=16, per_device=False, chunksize=1):
     """ Groups the provided os.DirEntry instances by the key generated by passing each to `keyfunc`.
 
     If `keyfunc(entry)` returns None, the item is filtered from the return.
 
+    Keys are evaluated on a pool of threads rather than processes. The hashing keys spend their time
+    in `readinto()` and `hash.update()`, both of which release the GIL: files are read into reusable
+    buffers up to `READAHEAD_WINDOW` bytes at a time and each window is hashed in one `update()`.
+    Threads therefore scale across cores without pickling DirEntry objects or hash state between
+    processes.
+
     :param fileset: A list of os.DirEntry instances to group.
     :param keyfunc: A function that takes an os.DirEntry as its sole argument and returns a hashable key.
     :param min_group_size: minimum number of entries a group needs to be returned (default: 2)
+    :param workers: number of worker threads used to evaluate `keyfunc` (default: 16)
+    :param per_device: If True, schedule evaluation per device with `evaluate_by_device` (default: False)
+    :param chunksize: number of entries handed to a worker at a time when not `per_device` (default: 1)
     :return: A list of lists of grouped os.DirEntry instances.
     """
-    pool = ThreadPool(workers)
-
-    def evaluate(entry):
-        return keyfunc(entry), entry
-
-    keyed_fileset = pool.map(evaluate, fileset)
-    files_by_key = {}
+    if per_device:
+        keyed_fileset = evaluate_by_device(fileset, keyfunc, workers=workers)
+    else:
+        keyed_fileset = evaluate_keys(fileset, keyfunc, workers=workers, chunksize=chunksize)
+    files_by_key = defaultdict(list)
     for key, entry in keyed_fileset:
         if key is None:
             continue
-        files_by_key.setdefault(key, []).append(entry)
+        files_by_key[key].append(entry)
 
     return [group for group in files_by_key.values() if
             len(group) >= min_group_size]
 
 
-def group_by_hash(fileset, hashfunc=hashlib.md5, min_group_size=2, workers=16):
+def group_by_hash(fileset, hashfunc=hashlib.sha256, min_group_size=2, workers=16, hash_states=None,
+                  start_offset=0, drop_cache=True):
     """ Takes a list of os.DirEntry instances (`fileset`) and an optional hash function.
 
     This function groups the os.DirEntry instances in the `fileset` list by hash (using `hashfunc`)
-    and returns lists of os.DirEntry instances, grouped by hash.
+    and returns lists of os.DirEntry instances, grouped by hash. Reads are scheduled per device
+    (see `evaluate_by_device`).
 
     Only groups larger than `min_group_size` are returned.
 
     :param fileset: A list of os.DirEntry instances to group.
-    :param hashfunc: hash function to use (default: hashlib.md5)
+    :param hashfunc: hash function to use (default: hashlib.sha256)
     :param min_group_size: minimum number of entries a group needs to be returned (default: 2)
+    :param hash_states: optional dict of partially fed hash objects to resume from (see `hash_key`)
+    :param start_offset: number of leading bytes already fed to the objects in `hash_states` (default: 0)
+    :param drop_cache: If True, drop each file's pages from the page cache once hashed (default: True)
     :return: lists of os.DirEntry instances grouped by hash value.
     """
-    return group_by_key(fileset, hash_key(hashfunc=hashfunc),
-                        min_group_size=min_group_size, workers=workers)
+    keyfunc = hash_key(hashfunc=hashfunc, hash_states=hash_states, start_offset=start_offset, drop_cache=drop_cache)
+    return group_by_key(fileset, keyfunc,
+                        min_group_size=min_group_size, workers=workers, per_device=True)
+
+
+def group_by_prefix_hash(fileset, nbytes=DEFAULT_PREFIX_SIZE, hashfunc=hashlib.sha256,
+                         min_group_size=2, workers=16, hash_states=None):
+    """ Takes a list of os.DirEntry instances (`fileset`) and groups them by the hash of their first `nbytes`.
+
+    Reads are scheduled per device (see `evaluate_by_device`).
+
+    Only groups larger than `min_group_size` are returned.
+
+    :param fileset: A list of os.DirEntry instances to group.
+    :param nbytes: number of bytes to read from the start of each file (default: 64KiB)
+    :param hashfunc: hash function to use (default: hashlib.sha256)
+    :param min_group_size: minimum number of entries a group needs to be returned (default: 2)
+    :param hash_states: optional dict that receives each file's running hash object (see `prefix_hash_key`)
+    :return: lists of os.DirEntry instances grouped by prefix hash value.
+    """
+    return group_by_key(fileset, prefix_hash_key(nbytes=nbytes, hashfunc=hashfunc, hash_states=hash_states),
+                        min_group_size=min_group_size, workers=workers, per_device=True)
 
 
 def group_by_size(fileset, min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE,
@@ -198,28 +518,150 @@ def group_by_size(fileset, min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE,
     :param min_group_size: minimum number of entries a group needs to be returned (default: 2)
     :return: lists of os.DirEntry instances grouped by size.
     """
+    # Stat calls are cheap, so hand them out in batches to keep per-task overhead down on huge trees
     return group_by_key(fileset, size_key(min_size=min_size, max_size=max_size),
-                        min_group_size=min_group_size, workers=workers)
+                        min_group_size=min_group_size, workers=workers, chunksize=256)
+
+
+def same_contents(path_a, path_b):
+    """ Returns True if the files at `path_a` and `path_b` hold identical bytes.
+
+    Works like `filecmp.cmp(shallow=False)`, but instead of a fixed 8KiB read size the chunk size
+    starts at 64KiB and doubles up to `READAHEAD_WINDOW`. Files that differ early are still rejected
+    after a small read, while large identical files are compared in a few big reads rather than
+    thousands of small ones. Both files are read into buffers lent by `read_buffer()`, so no `bytes`
+    objects are allocated per chunk.
+
+    Any OSError raised has its `filename` set to the path of the file that could not be read.
+
+    :param path_a: path of the first file
+    :param path_b: path of the second file
+    :return: `bool`
+    """
+    chunk_size = 64 * 1024
+
+    def read(fd, path, buffer):
+        try:
+            return fd.readinto(buffer[:chunk_size])
+        except OSError as exc:
+            exc.filename = path
+            raise
+
+    with open(path_a, 'rb') as fd_a, open(path_b, 'rb') as fd_b, \
+            read_buffer() as buffer_a, read_buffer() as buffer_b:
+        while True:
+            size = read(fd_a, path_a, buffer_a)
+            # bytearray.startswith() compares with memcmp; comparing two memoryviews goes byte by byte
+            if size != read(fd_b, path_b, buffer_b) or not buffer_a.obj.startswith(buffer_b[:size]):
+                return False
+            if not size:
+                return True
+            chunk_size = min(chunk_size * 2, READAHEAD_WINDOW)
+
+
+def verify_group(group, min_group_size=2):
+    """ Splits a group of files with matching hashes into groups of byte-for-byte identical files.
+
+    This guards against hash collisions, which matter when a fast non-cryptographic hash is used.
+
+    :param group: A list of os.DirEntry instances believed to be duplicates.
+    :param min_group_size: minimum number of entries a group needs to be returned (default: 2)
+    :return: lists of os.DirEntry instances with identical contents.
+    """
+    def matches(candidate, entry):
+        # Compare against the candidate group's first readable file, dropping any that can't be read
+        while candidate:
+            try:
+                return same_contents(candidate[0].path, entry.path)
+            except OSError as exc:
+                if exc.filename != candidate[0].path:
+                    raise
+                logger.warning(
+                    f"Skipping File (Could Not Open To Read): {candidate.pop(0).path}")
+        return False
+
+    groups = []
+    for entry in group:
+        try:
+            for candidate in groups:
+                if matches(candidate, entry):
+                    candidate.append(entry)
+                    break
+            else:
+                groups.append([entry])
+        except OSError:
+            logger.warning(
+                f"Skipping File (Could Not Open To Read): {entry.path}")
+
+    return [group for group in groups if len(group) >= min_group_size]
 
 
 def find_dupe_files(path, globs=None, exclusion_globs=None,
                     min_size=DEFAULT_MIN_SIZE,
-                    max_size=DEFAULT_MAX_SIZE, min_group_size=2, workers=16):
+                    max_size=DEFAULT_MAX_SIZE, min_group_size=2, workers=16,
+                    prefix_size=DEFAULT_PREFIX_SIZE, hashfunc=hashlib.sha256, verify=False, walk_workers=1):
     """ Walks `path` and returns a list of duplicated files in it.
 
+    Files are grouped by size, then by a hash of their first `prefix_size` bytes, and only
+    files that still collide are hashed in full, resuming from the prefix pass's hash state so the
+    prefix isn't read twice. Files no larger than `prefix_size` were already hashed in full by the
+    prefix pass, so the second pass is skipped for them.
+
+    Pairs of candidates are compared byte-by-byte instead of hashed, since a direct comparison
+    reads each file at most once and stops at the first difference. Pairs of empty files are
+    duplicates without being opened. The comparisons run on the worker pools once all groups have
+    been collected, scheduled per device like the hash passes.
+
     :param path: path string that we want to search.
     :param globs: A list of glob strings used to filter the fileset.
     :param exclusion_globs: Files matching globs in this list will not be evaluated.
     :param min_size: minimum file size in bytes (files smaller than this will be ignored)
     :param max_size: maximum file size in bytes (files larger than this will be ignored)
     :param min_group_size: minimum number of entries a group needs to be returned (default: 2)
+    :param prefix_size: number of leading bytes hashed by the prefilter pass (default: 64KiB)
+    :param hashfunc: hash function to use (default: hashlib.sha256)
+    :param verify: If True, compare grouped files byte-by-byte to rule out hash collisions (default: False)
+    :param walk_workers: number of threads scanning directories (default: 1)
     :return: lists of os.DirEntry instances pointing to duplicated files.
     """
-    dir_iter = walk(path, globs=globs, exclusion_globs=exclusion_globs)
+    dir_iter = walk(path, globs=globs, exclusion_globs=exclusion_globs, workers=walk_workers)
     dupes = []
+    pairs = []
     for group in group_by_size(dir_iter, min_size=min_size, max_size=max_size,
                                min_group_size=min_group_size, workers=workers):
-        dupes.extend(group_by_hash(group, min_group_size=min_group_size, workers=workers))
+        size = group[0].stat().st_size
+        if len(group) == 2:
+            if size == 0:
+                dupes.append(group)
+            else:
+                pairs.append(group)
+            continue
+
+        hash_states = {}
+        for subgroup in group_by_prefix_hash(group, nbytes=prefix_size, hashfunc=hashfunc,
+                                             min_group_size=min_group_size, workers=workers,
+                                             hash_states=hash_states):
+            if len(subgroup) == 2 and size > prefix_size:
+                pairs.append(subgroup)
+                continue
+
+            if size <= prefix_size:
+                hashed = [subgroup]
+            else:
+                # Keep the pages cached when the verify pass is about to read the same files again
+                hashed = group_by_hash(subgroup, hashfunc=hashfunc, min_group_size=min_group_size,
+                                       workers=workers, hash_states=hash_states, start_offset=prefix_size,
+                                       drop_cache=not verify)
+            for hashed_group in hashed:
+                if verify:
+                    dupes.extend(verify_group(hashed_group, min_group_size=min_group_size))
+                else:
+                    dupes.append(hashed_group)
+
+    # Pairs are compared on the worker pools, scheduled per device like the hash passes
+    for verified, _ in evaluate_by_device(pairs, lambda pair: verify_group(pair, min_group_size=min_group_size),
+                                          workers=workers, devicefunc=lambda pair: pair[0].stat().st_dev):
+        dupes.extend(verified)
     return dupes
 
 
@@ -227,8 +669,12 @@ if __name__ == "__main__":
     import json
 
     args = options()
+    if args.hash == 'sha256' and not sha256_is_accelerated():
+        logger.warning("sha256 may be slow: hashlib is not backed by OpenSSL 1.1.1+ (try --hash md5)")
     dupes = find_dupe_files(args.path, args.name, args.exclude, args.min_size,
-                            args.max_size, workers=args.workers)
+                            args.max_size, workers=args.workers,
+                            hashfunc=HASH_FUNCTIONS[args.hash], verify=args.verify,
+                            walk_workers=args.walk_workers)
     if args.json:
         print(json.dumps([[entry.path for entry in d] for d in dupes]))
     else:
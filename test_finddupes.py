@@ -1,10 +1,66 @@
+import hashlib
+import importlib
+import os
+import sys
+import threading
+from tempfile import TemporaryDirectory
 from unittest import TestCase
+from unittest.mock import patch
 
-from finddupes import find_dupe_files, group_by_size, walk, group_by_hash
+import finddupes
+from finddupes import find_dupe_files, group_by_size, walk, group_by_hash, group_by_prefix_hash, \
+    verify_group, sha256_is_accelerated, READAHEAD_WINDOW, compile_globs, is_rotational, \
+    evaluate_by_device, size_key, evaluate_keys, hash_key, prefix_hash_key, same_contents
 
 TEST_DATA_DIR = './test_data'
 
 
+def write_files(tmp, files):
+    paths = []
+    for name, data in files.items():
+        paths.append(os.path.join(tmp, name))
+        with open(paths[-1], 'wb') as fd:
+            fd.write(data)
+    return paths
+
+
+class TestSha256(TestCase):
+
+    def test_openssl_sha256(self):
+        def openssl_sha256():
+            pass
+
+        with patch('hashlib.sha256', openssl_sha256):
+            with patch('ssl.OPENSSL_VERSION_INFO', (1, 1, 1, 0, 15)):
+                self.assertTrue(sha256_is_accelerated())
+            with patch('ssl.OPENSSL_VERSION_INFO', (1, 0, 2, 21, 15)):
+                self.assertFalse(sha256_is_accelerated())
+
+    def test_builtin_sha256(self):
+        def sha256():
+            pass
+
+        with patch('hashlib.sha256', sha256), patch('ssl.OPENSSL_VERSION_INFO', (3, 0, 0, 0, 0)):
+            self.assertFalse(sha256_is_accelerated())
+
+    def test_no_ssl(self):
+        def openssl_sha256():
+            pass
+
+        with patch('hashlib.sha256', openssl_sha256), patch('finddupes.ssl', None):
+            self.assertFalse(sha256_is_accelerated())
+
+    def test_import_without_ssl(self):
+        with patch.dict(sys.modules, {'ssl': None}):
+            del sys.modules['finddupes']
+            try:
+                module = importlib.import_module('finddupes')
+                self.assertIsNone(module.ssl)
+                self.assertFalse(module.sha256_is_accelerated())
+            finally:
+                sys.modules['finddupes'] = finddupes
+
+
 class TestWalk(TestCase):
 
     def test_walk_invalid_dir(self):
@@ -13,6 +69,34 @@ class TestWalk(TestCase):
     def test_walk_file(self):
         self.assertEqual([], list(walk('requirements.txt')))
 
+    def test_walk_globs(self):
+        names = {entry.name for entry in walk(TEST_DATA_DIR, globs=['*.gif', '8*'], exclusion_globs=['dir1'])}
+        self.assertEqual({'unique.gif', '8bytes.txt'}, names)
+
+    def test_walk_workers(self):
+        serial = sorted(entry.path for entry in walk(TEST_DATA_DIR))
+        self.assertEqual(serial, sorted(entry.path for entry in walk(TEST_DATA_DIR, workers=4)))
+        self.assertEqual([], list(walk('doesnt/exist/', workers=4)))
+
+    def test_walk_symlinked_dir(self):
+        with TemporaryDirectory() as tmp:
+            os.symlink(os.path.abspath(os.path.join(TEST_DATA_DIR, 'dirb')), os.path.join(tmp, 'link'))
+            self.assertEqual([], list(walk(tmp)))
+            self.assertEqual(3, len(list(walk(tmp, followlinks=True))))
+
+
+class TestCompileGlobs(TestCase):
+
+    def test_no_globs(self):
+        self.assertIsNone(compile_globs(None))
+        self.assertIsNone(compile_globs([]))
+
+    def test_any_glob(self):
+        glob_re = compile_globs(['*.txt', 'unique.???'])
+        self.assertTrue(glob_re.match('8bytes.txt'))
+        self.assertTrue(glob_re.match('unique.gif'))
+        self.assertFalse(glob_re.match('8bytes.txt.bak'))
+
 
 class TestGroupBySize(TestCase):
 
@@ -35,6 +119,99 @@ class TestGroupBySize(TestCase):
                 self.assertEqual(1, len(group))
 
 
+class TestEvaluateKeys(TestCase):
+
+    def test_evaluate_keys(self):
+        keyed = list(evaluate_keys(walk(TEST_DATA_DIR), size_key(), chunksize=4))
+        self.assertEqual(13, len(keyed))
+
+    def test_evaluate_keys_bounded(self):
+        pulled = []
+
+        def fileset():
+            for i in range(100000):
+                pulled.append(i)
+                yield i
+
+        keyed = evaluate_keys(fileset(), lambda entry: entry, workers=2, chunksize=4)
+        next(keyed)
+        self.assertLessEqual(len(pulled), 2 * 4 * 4 + 1)
+        self.assertEqual(100000, 1 + sum(1 for _ in keyed))
+
+    def test_evaluate_keys_closed_early(self):
+        threads = threading.active_count()
+        keyed = evaluate_keys(range(100000), lambda entry: entry, workers=2)
+        next(keyed)
+        self.assertGreater(threading.active_count(), threads)
+        keyed.close()
+        self.assertEqual(threads, threading.active_count())
+
+    def test_evaluate_keys_raises(self):
+        def keyfunc(entry):
+            if entry == 50:
+                raise RuntimeError('bad entry')
+            return entry
+
+        threads = threading.active_count()
+        with self.assertRaisesRegex(RuntimeError, 'bad entry'):
+            list(evaluate_keys(range(100000), keyfunc, workers=2))
+        self.assertEqual(threads, threading.active_count())
+
+
+class TestIsRotational(TestCase):
+
+    def setUp(self):
+        is_rotational.cache_clear()
+
+    def tearDown(self):
+        is_rotational.cache_clear()
+
+    def assertRotational(self, expected, sys_path, queues):
+        with TemporaryDirectory() as tmp:
+            for disk, rotational in queues.items():
+                os.makedirs(os.path.join(tmp, disk, 'queue'))
+                with open(os.path.join(tmp, disk, 'queue', 'rotational'), 'w') as fd:
+                    fd.write(rotational)
+            with patch('os.path.realpath', return_value=os.path.join(tmp, sys_path)) as realpath:
+                self.assertEqual(expected, is_rotational(os.makedev(8, 1)))
+            realpath.assert_called_once_with('/sys/dev/block/8:1')
+
+    def test_disk(self):
+        self.assertRotational(True, 'sda', {'sda': '1\n'})
+        is_rotational.cache_clear()
+        self.assertRotational(False, 'nvme0n1', {'nvme0n1': '0\n'})
+
+    def test_partition_uses_parent_disk(self):
+        self.assertRotational(True, 'sda/sda1', {'sda': '1\n'})
+
+    def test_unknown_device(self):
+        self.assertRotational(False, 'virtual/0:42', {})
+
+    def test_real_device(self):
+        self.assertIsInstance(is_rotational(os.stat(TEST_DATA_DIR).st_dev), bool)
+
+
+class TestEvaluateByDevice(TestCase):
+
+    def test_evaluate(self):
+        keyed = list(evaluate_by_device(walk(TEST_DATA_DIR), size_key()))
+        self.assertEqual(13, len(keyed))
+        for key, entry in keyed:
+            self.assertEqual(entry.stat().st_size, key)
+
+    def test_evaluate_empty(self):
+        self.assertEqual([], list(evaluate_by_device([], size_key())))
+
+    def test_one_worker_per_rotational_device(self):
+        devices = {'hdd-1': 'hdd', 'hdd-2': 'hdd', 'ssd-1': 'ssd', 'ssd-2': 'ssd'}
+        with patch('finddupes.is_rotational', side_effect=lambda device: device == 'hdd'), \
+                patch('finddupes.evaluate_keys', wraps=evaluate_keys) as wrapped:
+            keyed = evaluate_by_device(devices, str.upper, workers=8, devicefunc=devices.get)
+            self.assertEqual(sorted(name.upper() for name in devices), sorted(key for key, _ in keyed))
+        workers = {tuple(call[0][0]): call[1]['workers'] for call in wrapped.call_args_list}
+        self.assertEqual({('hdd-1', 'hdd-2'): 1, ('ssd-1', 'ssd-2'): 8}, workers)
+
+
 class TestGroupByHash(TestCase):
 
     def test_group_files(self):
@@ -45,6 +222,52 @@ class TestGroupByHash(TestCase):
             self.assertTrue(group[0].name in ['12bytes.txt', '8bytes.txt', 'empty.txt'])
             self.assertEqual(4, len(group))
 
+    def test_group_large_files(self):
+        with TemporaryDirectory() as tmp:
+            data = os.urandom(READAHEAD_WINDOW + 1)
+            write_files(tmp, {'a': data + b'1', 'b': data + b'1', 'c': data + b'2'})
+            groups = group_by_hash(walk(tmp))
+            self.assertEqual(1, len(groups))
+            self.assertEqual(['a', 'b'], sorted(entry.name for entry in groups[0]))
+
+    def test_file_shrinks_while_hashing(self):
+        with TemporaryDirectory() as tmp:
+            path, = write_files(tmp, {'a': os.urandom(READAHEAD_WINDOW * 2)})
+            entry = next(walk(tmp))
+            entry.stat()
+            os.truncate(path, 100)
+            with open(path, 'rb') as fd:
+                self.assertEqual(hashlib.sha256(fd.read()).digest(), hash_key()(entry))
+
+
+class TestGroupByPrefixHash(TestCase):
+
+    def test_group_files(self):
+        file_iter = walk(TEST_DATA_DIR, "*.txt")
+        groups = group_by_prefix_hash(file_iter)
+        self.assertEqual(3, len(groups))
+        for group in groups:
+            self.assertTrue(group[0].name in ['12bytes.txt', '8bytes.txt', 'empty.txt'])
+            self.assertEqual(4, len(group))
+
+    def test_shared_prefix(self):
+        with TemporaryDirectory() as tmp:
+            write_files(tmp, {'a': b'same-prefix-1', 'b': b'same-prefix-2'})
+            self.assertEqual(1, len(group_by_prefix_hash(walk(tmp), nbytes=4)))
+            self.assertEqual([], find_dupe_files(tmp, prefix_size=4))
+
+    def test_resume_from_prefix(self):
+        with TemporaryDirectory() as tmp:
+            write_files(tmp, {'small': os.urandom(100), 'huge': os.urandom(READAHEAD_WINDOW * 2 + 1)})
+            for entry in walk(tmp):
+                hash_states = {}
+                prefix_hash_key(nbytes=4, hash_states=hash_states)(entry)
+                resumed = hash_key(hash_states=hash_states, start_offset=4)(entry)
+                self.assertEqual({}, hash_states)
+                self.assertEqual(hash_key()(entry), resumed)
+                with open(entry.path, 'rb') as fd:
+                    self.assertEqual(hashlib.sha256(fd.read()).digest(), resumed)
+
 
 class TestFindDupes(TestCase):
 
@@ -105,3 +328,74 @@ class TestFindDupes(TestCase):
         for group in groups:
             self.assertEqual(len(group), 3)
             self.assertEqual(group[0].name, '8bytes.txt')
+
+    def test_pair(self):
+        with TemporaryDirectory() as tmp:
+            write_files(tmp, {'a': b'12345678', 'b': b'12345678'})
+            groups = find_dupe_files(tmp)
+            self.assertEqual(1, len(groups))
+            self.assertEqual(['a', 'b'], sorted(entry.name for entry in groups[0]))
+
+    def test_empty_pair(self):
+        with TemporaryDirectory() as tmp:
+            write_files(tmp, {'a': b'', 'b': b''})
+            with patch('finddupes.same_contents') as same_contents:
+                groups = find_dupe_files(tmp)
+            same_contents.assert_not_called()
+            self.assertEqual(1, len(groups))
+            self.assertEqual(['a', 'b'], sorted(entry.name for entry in groups[0]))
+
+    def test_walk_workers(self):
+        groups = find_dupe_files(TEST_DATA_DIR, walk_workers=4)
+        self.assertEqual(3, len(groups))
+
+    def test_verify_keeps_page_cache(self):
+        with TemporaryDirectory() as tmp:
+            data = os.urandom(1024 * 1024)
+            write_files(tmp, {'a': data, 'b': data, 'c': data})
+            for verify, dropped in [(True, 0), (False, 3)]:
+                with patch('finddupes.fadvise') as fadvise:
+                    self.assertEqual(1, len(find_dupe_files(tmp, verify=verify)))
+                advice = [call[0][1] for call in fadvise.call_args_list]
+                self.assertEqual(dropped, advice.count('POSIX_FADV_DONTNEED'))
+
+    def test_verify(self):
+        groups = find_dupe_files(TEST_DATA_DIR, globs=['*.txt'], verify=True)
+        self.assertEqual(len(groups), 3)
+        for group in groups:
+            self.assertEqual(len(group), 4)
+
+
+class TestSameContents(TestCase):
+
+    def test_same_contents(self):
+        with TemporaryDirectory() as tmp:
+            data = os.urandom(READAHEAD_WINDOW * 2)
+            paths = write_files(tmp, {'a': data + b'1', 'b': data + b'1', 'c': data + b'2', 'd': b''})
+            self.assertTrue(same_contents(paths[0], paths[1]))
+            self.assertFalse(same_contents(paths[0], paths[2]))
+            self.assertFalse(same_contents(paths[0], paths[3]))
+            self.assertTrue(same_contents(paths[3], paths[3]))
+
+
+class TestVerifyGroup(TestCase):
+
+    def test_split_collision(self):
+        with TemporaryDirectory() as tmp:
+            write_files(tmp, {'a': b'1234', 'b': b'1234', 'c': b'4321'})
+            groups = verify_group(sorted(walk(tmp), key=lambda entry: entry.name))
+            self.assertEqual(1, len(groups))
+            self.assertEqual(['a', 'b'], [entry.name for entry in groups[0]])
+
+    def test_unreadable_files(self):
+        with TemporaryDirectory() as tmp:
+            write_files(tmp, dict.fromkeys(['a', 'b', 'c', 'd'], b'1234'))
+            entries = sorted(walk(tmp), key=lambda entry: entry.name)
+            os.remove(os.path.join(tmp, 'a'))
+            os.remove(os.path.join(tmp, 'c'))
+            with self.assertLogs('finddupes', level='WARNING') as logs:
+                groups = verify_group(entries)
+            self.assertEqual([['b', 'd']], [[entry.name for entry in group] for group in groups])
+            self.assertEqual(2, len(logs.output))
+            self.assertIn(os.path.join(tmp, 'a'), logs.output[0])
+            self.assertIn(os.path.join(tmp, 'c'), logs.output[1])